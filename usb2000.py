@@ -26,8 +26,9 @@ A simple and fast pyqtgraph-based UI for use with Ocean Optics spectrometers.
 * Author(s): Paul Bupe Jr
 """
 
-import csv
+import inspect
 import sys
+import threading
 import time
 
 import numpy as np
@@ -35,8 +36,280 @@ import pyqtgraph as pg
 from pyqtgraph.Qt import QtCore, QtGui, QtWidgets
 from seabreeze.spectrometers import Spectrometer
 
+try:
+    from numba import njit
+
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+
+def _fill_polygon_numpy(x, y, out):
+    out[:, 0] = x
+    out[:, 1] = y
+
+
+def _fill_polygon_y_numpy(y, out):
+    out[:, 1] = y
+
+
+def _m4_indices_numpy(y, n_px, b, out):
+    n = n_px * b
+    bins = y[:n].reshape(n_px, b)
+    starts = np.arange(0, n, b)
+    out[:, 0] = starts
+    out[:, 1] = starts + bins.argmin(axis=1)
+    out[:, 2] = starts + bins.argmax(axis=1)
+    out[:, 3] = starts + b - 1
+    out.sort(axis=1)
+
+
+def _ema_update_numpy(avg, new, alpha, scratch):
+    # avg = (1 - alpha) * avg + alpha * new, without temporaries
+    np.multiply(avg, 1 - alpha, out=avg)
+    np.multiply(new, alpha, out=scratch)
+    avg += scratch
+
+
+def _use_numpy_kernels():
+    # also used when numba is installed but fails to compile a kernel
+    global HAVE_NUMBA, _fill_polygon, _fill_polygon_y, _m4_indices, _ema_update
+    HAVE_NUMBA = False
+    _fill_polygon = _fill_polygon_numpy
+    _fill_polygon_y = _fill_polygon_y_numpy
+    _m4_indices = _m4_indices_numpy
+    _ema_update = _ema_update_numpy
+
+
+if HAVE_NUMBA:
+
+    @njit(cache=True, fastmath=True)
+    def _fill_polygon(x, y, out):
+        # interleave x and y into a QPolygonF's (n, 2) float64 point buffer
+        for i in range(x.shape[0]):
+            out[i, 0] = x[i]
+            out[i, 1] = y[i]
+
+    @njit(cache=True, fastmath=True)
+    def _fill_polygon_y(y, out):
+        for i in range(y.shape[0]):
+            out[i, 1] = y[i]
+
+    @njit(cache=True)
+    def _m4_indices(y, n_px, b, out):
+        # first, min, max and last sample index of each bin, in index order
+        for j in range(n_px):
+            start = j * b
+            lo = start
+            hi = start
+            for i in range(start + 1, start + b):
+                if y[i] < y[lo]:
+                    lo = i
+                elif y[i] > y[hi]:
+                    hi = i
+            out[j, 0] = start
+            out[j, 1] = min(lo, hi)
+            out[j, 2] = max(lo, hi)
+            out[j, 3] = start + b - 1
+
+    @njit(cache=True, fastmath=True)
+    def _ema_update(avg, new, alpha, scratch):
+        # fold new into the running average in one pass, casting as it goes;
+        # scratch is only needed by the NumPy version
+        for i in range(avg.shape[0]):
+            avg[i] = avg[i] + alpha * (new[i] - avg[i])
+
+else:
+    _use_numpy_kernels()
+
+
+def _warm_up_kernels():
+    """
+    Call every kernel once with the dtypes used at runtime so numba compiles
+    them (or loads them from its cache) before the first frame.
+    """
+    x = np.zeros(4, dtype=np.float32)
+    y = np.zeros(4, dtype=np.float32)
+    _fill_polygon(x, y, np.zeros((4, 2)))
+    _fill_polygon_y(y, np.zeros((4, 2)))
+    _m4_indices(y, 1, 4, np.empty((1, 4), dtype=np.intp))
+    _ema_update(y, np.zeros(4), 0.5, np.zeros(4, dtype=np.float32))
+
+
+def _downsample(x, y, n_px):
+    """
+    M4 downsampling: keep the first, min, max and last sample of each of
+    *n_px* bins so the curve looks the same at the plot's pixel width.
+    """
+    b = len(y) // max(n_px, 1)
+    if b <= 4:
+        # no more than four samples per pixel, nothing to drop
+        return x, y
+
+    n = n_px * b
+    idx = np.empty((n_px, 4), dtype=np.intp)
+    _m4_indices(y, n_px, b, idx)
+
+    # samples past the last full bin are kept as-is
+    idx = np.concatenate((idx.ravel(), np.arange(n, len(y))))
+    return x[idx], y[idx]
+
+
+def _new_polygon(n):
+    poly = pg.functions.create_qpolygonf(n)
+    return poly, pg.functions.ndarray_from_qpolygonf(poly)
+
+
+class _QPathBuilder:
+    """
+    Stand-in for pyqtgraph's arrayToQPath that reuses QPolygonF buffers
+    across frames and fills them in one pass. When the x values are the
+    fixed wavelength axis, only the y column is rewritten. Anything other
+    than a fully connected curve without finite checks goes to the
+    original function.
+    """
+
+    def __init__(self, fallback):
+        self._fallback = fallback
+        self._poly = None
+        self._points = None
+        self._fixed_x = None
+        self._fixed_poly = None
+        self._fixed_points = None
+
+    def set_fixed_x(self, x):
+        self._fixed_x = x
+        self._fixed_poly, self._fixed_points = _new_polygon(x.shape[0])
+        self._fixed_points[:, 0] = x
+
+    def _is_fixed_x(self, x):
+        fixed = self._fixed_x
+        return (
+            fixed is not None
+            and (x is fixed or x.base is fixed)
+            and x.shape == fixed.shape
+            and x.strides == fixed.strides
+        )
+
+    def __call__(self, x, y, connect="all", finiteCheck=True):
+        n = x.shape[0]
+        if connect != "all" or finiteCheck or n == 0:
+            return self._fallback(x, y, connect=connect, finiteCheck=finiteCheck)
+
+        if self._is_fixed_x(x):
+            poly = self._fixed_poly
+            _fill_polygon_y(y, self._fixed_points)
+        else:
+            if self._poly is None or len(self._poly) != n:
+                self._poly, self._points = _new_polygon(n)
+            poly = self._poly
+            _fill_polygon(x, y, self._points)
+
+        # addPolygon copies the points, so the polygon can be refilled
+        path = QtGui.QPainterPath()
+        if hasattr(path, "reserve"):  # Qt 5.13
+            path.reserve(n)
+        path.addPolygon(poly)
+        return path
+
+
+class AcqWorker(QtCore.QObject):
+    """Reads spectra in a background thread and emits each one as a frame."""
+
+    sig_frame = QtCore.Signal(object)
+    sig_error = QtCore.Signal(str)
+
+    # consecutive failed reads before the worker gives up
+    max_failures = 10
+
+    # slots in the frame ring, i.e. frames in flight to the GUI thread
+    ring_depth = 4
+
+    def __init__(self, spec, n_pixels, *args, **kwargs):
+        super(AcqWorker, self).__init__(*args, **kwargs)
+        self.spec = spec
+        self._running = False
+
+        # read straight into a ring of frames if seabreeze supports it
+        try:
+            read_into = "out" in inspect.signature(spec.intensities).parameters
+        except (TypeError, ValueError):
+            read_into = False
+        self._ring = np.empty((self.ring_depth, n_pixels)) if read_into else None
+        self._ring_idx = 0
+        # a slot is free again once the GUI has released the frame in it
+        self._free_slots = threading.Semaphore(self.ring_depth)
+
+    def read(self):
+        if self._ring is None:
+            # a fresh array per call is already safe to hand to the GUI thread
+            return self.spec.intensities()
+        # wait for the GUI to release the oldest frame before overwriting it
+        while not self._free_slots.acquire(timeout=0.1):
+            if not self._running:
+                return None
+        idx = self._ring_idx
+        frame = self._ring[idx]
+        self._ring_idx = (idx + 1) % self.ring_depth
+        try:
+            self.spec.intensities(out=frame)
+        except Exception:
+            # the frame never reached the GUI, so hand its slot back
+            self._ring_idx = idx
+            self._free_slots.release()
+            raise
+        return frame
+
+    def run(self):
+        process_events = QtCore.QCoreApplication.processEvents
+        read = self.read
+        emit = self.sig_frame.emit
+
+        failures = 0
+        while self._running:
+            # deliver queued slots (e.g. integration time changes) between reads
+            process_events()
+            try:
+                frame = read()
+            except Exception as e:
+                print(e)
+                failures += 1
+                if failures >= self.max_failures:
+                    self._running = False
+                    self.sig_error.emit(str(e))
+                    break
+                # back off so a missing device doesn't spin the thread
+                QtCore.QThread.msleep(min(1000, 10 * 2**failures))
+                continue
+            if frame is None:
+                # stopped while waiting for a free slot
+                continue
+            failures = 0
+            emit(frame)
+
+    def start(self):
+        # set from the GUI thread before the thread starts, so a stop()
+        # that comes before run() is not undone
+        self._running = True
+
+    def stop(self):
+        self._running = False
+
+    def release_frame(self):
+        # called from the GUI thread once a frame has been consumed
+        if self._ring is not None:
+            self._free_slots.release()
+
+    def set_integration_time(self, integration_time_us):
+        try:
+            self.spec.integration_time_micros(integration_time_us)
+        except Exception as e:
+            print(e)
+
 
 class USB2000(QtWidgets.QMainWindow):
+    sig_integration_time = QtCore.Signal(int)
+
     def __init__(self, *args, **kwargs):
         super(USB2000, self).__init__(*args, **kwargs)
         self.integration_time_us = 20000
@@ -44,64 +317,110 @@ class USB2000(QtWidgets.QMainWindow):
         self.spec = None
         self.initialized = False
         self.wavelengths = []
-        self.intensities = []
+        self._plot_wavelengths = []
         self.averaged_intensities = []
         self.scans_to_average = 4
+        self._alpha = 1.0 / self.scans_to_average
         self.capturing = False
+        self._ema_primed = False
+        self.acq_thread = None
+        self.acq_worker = None
+        self._last_status_idx = -1
 
         self.build_main_ui()
         self.build_toolbar()
         self.build_plot()
 
         self.start_time = time.time()
+        # repaint at the spectrometer's frame rate, independent of frame delivery
+        self._frame_ready = False
         self.timer = QtCore.QTimer()
+        self.timer.setTimerType(QtCore.Qt.PreciseTimer)
         self.timer.timeout.connect(self.update)
-        self.timer.start(30)  # USB scans into memory every 13ms
+        self.timer.start(self.frame_interval_ms())
         self.show()
 
+    def frame_interval_ms(self):
+        return max(5, self.integration_time_us // 1000 + 2)
+
     def update(self):
-        if self.capturing:
-            if self.initialized:
-                self.read_spectrum()
-                self.plot.setData(self.wavelengths, self.averaged_intensities)
+        if not (self.capturing and self.initialized and self._frame_ready):
+            return
+        self._frame_ready = False
+        # plot a copy so later frames don't change data pyqtgraph still holds
+        snapshot = self._plot_snapshot
+        np.copyto(snapshot, self.averaged_intensities)
+        x, y = _downsample(self._plot_wavelengths, snapshot, self.plot_widget.width())
+        self.plot.setData(x, y)
+
+    def _on_frame(self, intensities):
+        # Runs on the GUI thread
+        try:
+            if self.capturing:
+                self._fold_frame(intensities)
+        finally:
+            # hand the frame's ring slot back to the worker
+            self.acq_worker.release_frame()
+
+    def _fold_frame(self, intensities):
+        # scans_to_average sets the window of the running exponential average
+        avg = self.averaged_intensities
+        if not self._ema_primed:
+            np.copyto(avg, intensities)
+            self._ema_primed = True
+        else:
+            _ema_update(avg, intensities, self._alpha, self._ema_scratch)
+        self._frame_ready = True
 
     def init_spectrometer(self):
+        # compile the numba kernels up front so the first frame never waits
+        # on the JIT; if numba can't build them, plot with the NumPy versions
+        try:
+            _warm_up_kernels()
+        except Exception as e:
+            print(e)
+            _use_numpy_kernels()
+
         try:
             self.spec = Spectrometer.from_first_available()
             self.spec.integration_time_micros(self.integration_time_us)
             self.wavelengths = self.spec.wavelengths()
+            # float32 halves the bytes pushed through the plot each frame;
+            # export and the cursor readout keep the float64 calibration
+            self._plot_wavelengths = self.wavelengths.astype(np.float32)
+            self.averaged_intensities = np.empty(
+                len(self.wavelengths), dtype=np.float32
+            )
+            self._ema_scratch = np.empty_like(self.averaged_intensities)
+            self._plot_snapshot = np.empty_like(self.averaged_intensities)
+            self._qpath_builder.set_fixed_x(self._plot_wavelengths)
+            self.plot.setData(
+                x=self._plot_wavelengths, y=np.zeros_like(self._plot_wavelengths)
+            )
             self.plot_widget.setXRange(
                 self.wavelengths[0], self.wavelengths[-1], padding=0
             )
 
+            # acquisition runs in its own thread and posts frames back
+            self.acq_thread = QtCore.QThread()
+            self.acq_worker = AcqWorker(self.spec, len(self.wavelengths))
+            self.acq_worker.moveToThread(self.acq_thread)
+            self.acq_thread.started.connect(self.acq_worker.run)
+            self.acq_worker.sig_frame.connect(self._on_frame)
+            self.acq_worker.sig_error.connect(self._on_acq_error)
+            self.sig_integration_time.connect(self.acq_worker.set_integration_time)
+
             self.initialized = True
-            self.status_label.setText("Device initialized: " + self.spec.model)
+            self.set_status("Device initialized: " + self.spec.model)
 
             # disable connection button
             self.connect_button.setEnabled(False)
             self.start_capture_button.setEnabled(True)
         except Exception as e:
             print(e)
-            self.status_label.setText("No device detected")
+            self.set_status("No device detected")
             return
 
-    def read_spectrum(self):
-
-        self.intensities = []
-
-        for i in range(self.scans_to_average):
-            try:
-                intensities = self.spec.intensities()
-                self.intensities.append(intensities)
-            except Exception as e:
-                print(e)
-
-        # If list not empty, average
-        if len(self.intensities) > 0:
-            self.averaged_intensities = np.mean(self.intensities, axis=0)
-            self.intensities = []
-        # self.averaged_intensities = np.mean(self.intensities, axis=0)
-
     def update_device_list(self):
         self.devices_dropdown.currentIndexChanged.disconnect()
         self.devices_dropdown.clear()
@@ -111,24 +430,32 @@ class USB2000(QtWidgets.QMainWindow):
     def update_integration_time(self):
         try:
             self.integration_time_us = int(self.integration_time_edit.text())
-            self.spec.integration_time_micros(self.integration_time_us)
+            # applied by the acquisition thread between reads
+            self.sig_integration_time.emit(self.integration_time_us)
+            self.timer.setInterval(self.frame_interval_ms())
         except Exception as e:
             print(e)
 
     def update_scans_to_average(self):
         try:
-            self.scans_to_average = int(self.scans_to_average_edit.text())
+            self.scans_to_average = max(1, int(self.scans_to_average_edit.text()))
+            self._alpha = 1.0 / self.scans_to_average
         except Exception as e:
             print(e)
 
     def start_capture(self):
+        # restart the running average from the first new scan
+        self._ema_primed = False
         self.capturing = True
+        self.acq_worker.start()
+        self.acq_thread.start()
         # disable start button
         self.start_capture_button.setEnabled(False)
         self.stop_capture_button.setEnabled(True)
 
     def stop_capture(self):
         self.capturing = False
+        self.stop_acquisition()
 
         # enable start button
         self.start_capture_button.setEnabled(True)
@@ -136,9 +463,25 @@ class USB2000(QtWidgets.QMainWindow):
         # clear plot
         # self.plot.clear()
 
+    def _on_acq_error(self, message):
+        # the worker has stopped after repeated failed reads
+        self.stop_capture()
+        self.set_status("ERROR: " + message)
+
+    def stop_acquisition(self):
+        if self.acq_thread is not None and self.acq_thread.isRunning():
+            self.acq_worker.stop()
+            self.acq_thread.quit()
+            self.acq_thread.wait()
+
+    def closeEvent(self, event):
+        self.stop_acquisition()
+        super(USB2000, self).closeEvent(event)
+
     def export_data(self):
-        if self.intensities is None:
-            self.status_label.setText("ERROR: No data to export")
+        # nothing has been averaged until the first frame of a capture arrives
+        if not (self.initialized and self._ema_primed):
+            self.set_status("ERROR: No data to export")
             return
 
         # get file name
@@ -149,28 +492,43 @@ class USB2000(QtWidgets.QMainWindow):
         filename = filename[0]
         if not filename:
             # update status label
-            self.status_label.setText("ERROR: No file selected")
+            self.set_status("ERROR: No file selected")
             return
 
         # write data to file
-        with open(filename, "w", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow(["Wavelength", "Intensity"])
-            for i in range(len(self.wavelengths)):
-                writer.writerow([self.wavelengths[i], self.averaged_intensities[i]])
+        np.savetxt(
+            filename,
+            np.column_stack((self.wavelengths, self.averaged_intensities)),
+            fmt=("%.6f", "%.6f"),
+            delimiter=",",
+            header="Wavelength,Intensity",
+            comments="",
+        )
 
-        self.status_label.setText("INFO: Data exported to %s" % filename)
+        self.set_status("INFO: Data exported to %s" % filename)
+
+    def set_status(self, text):
+        self.status_label.setText(text)
+        # the cursor readout was replaced; redraw it on the next mouse move
+        self._last_status_idx = -1
 
     def mouse_moved(self, event):
         pos = event[0]
-        if self.plot_widget.sceneBoundingRect().contains(pos):
-            mouse_point = self.plot_widget.plotItem.vb.mapSceneToView(pos)
+        if self._plot_rect.contains(pos):
+            mouse_point = self._vb.mapSceneToView(pos)
             index = int(mouse_point.x())
+            self.v_line.setPos(mouse_point.x())
+            # only redraw the status label when the index changes
+            if index == self._last_status_idx:
+                return
+            self._last_status_idx = index
             if index > 0 and index < len(self.wavelengths):
                 self.status_label.setText(
-                    "Wavelength: {:.2f} nm".format(self.wavelengths[index])
+                    f"Wavelength: {self.wavelengths[index]:.2f} nm"
                 )
-            self.v_line.setPos(mouse_point.x())
+
+    def update_plot_rect(self):
+        self._plot_rect = self.plot_widget.plotItem.sceneBoundingRect()
 
     def build_main_ui(self):
         self.main_layout = QtWidgets.QGridLayout()
@@ -199,7 +557,14 @@ class USB2000(QtWidgets.QMainWindow):
               """
         )
         self.resize(1300, 600)
-        pg.setConfigOptions(antialias=True)
+        # draw the live curve with OpenGL when PyOpenGL is available
+        try:
+            import OpenGL  # noqa: F401
+
+            pg.setConfigOptions(useOpenGL=True, enableExperimental=True)
+        except ImportError:
+            pass
+        pg.setConfigOptions(antialias=False)
 
     def build_plot(self):
         self.plot_widget = pg.PlotWidget()
@@ -216,11 +581,29 @@ class USB2000(QtWidgets.QMainWindow):
         self.plot_widget.setMouseEnabled(x=False, y=False)
 
         self.v_line = pg.InfiniteLine(angle=90, movable=False)
+        # the cursor line only changes on mouse moves; keep it rasterized
+        self.v_line.setCacheMode(QtWidgets.QGraphicsItem.DeviceCoordinateCache)
         self.plot_widget.addItem(self.v_line, ignore_bounds=True)
 
-        self.plot = self.plot_widget.plot(np.zeros(1), pen=(0, 255, 0))
+        # downsampling is done by _downsample before setData
+        self.plot = self.plot_widget.plot(
+            np.zeros(1),
+            pen=(0, 255, 0),
+            antialias=False,
+            skipFiniteCheck=True,
+            autoDownsample=False,
+        )
+        self._qpath_builder = _QPathBuilder(pg.functions.arrayToQPath)
+        pg.functions.arrayToQPath = self._qpath_builder
+
+        # cache what mouse_moved needs; the plot rect only changes on resize
+        plot_item = self.plot_widget.plotItem
+        self._vb = plot_item.vb
+        self._plot_rect = plot_item.sceneBoundingRect()
+        plot_item.geometryChanged.connect(self.update_plot_rect)
+
         self.proxy = pg.SignalProxy(
-            self.plot_widget.scene().sigMouseMoved, rateLimit=60, slot=self.mouse_moved
+            self.plot_widget.scene().sigMouseMoved, rateLimit=30, slot=self.mouse_moved
         )
         self.main_layout.addWidget(self.plot_widget, 0, 0, 1, 1)
 